@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
-from setuptools import setup
+if __name__ == "__main__":
+    from setuptools import setup
 
-setup()
+    setup()
@@ -3,12 +3,15 @@ from __future__ import annotations
 
 import argparse
 import errno
+import functools
+import io
+import itertools
 import logging
 import os.path
 import re
 import sqlite3
 import sys
-import tempfile
+from typing import Callable
 from typing import IO
 from typing import Iterable
 from typing import Iterator
@@ -71,6 +74,12 @@ sensitive file names.
 """
 
 LOAD_ROWS_MAX_BUFFER = 1000
+READ_BUFFER_SIZE = 1 << 20
+PRINT_OUTPUT_MAX_BUFFER = 1000
+# Smallest default limit on ? parameters per statement, used by SQLite before 3.32
+SQLITE_MAX_VARIABLES = 999
+# Default limit on attached databases, for Pythons without Connection.getlimit
+SQLITE_MAX_ATTACHED = 10
 
 
 def main() -> None:
@@ -117,10 +126,24 @@ def main() -> None:
         default=False,
         help="Include a header row in the output",
     )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        default=False,
+        help=(
+            "Save loaded files as SQLite databases under $XDG_CACHE_HOME/shellquery, "
+            "and reuse them in later queries as long as the file's size and modification time "
+            "haven't changed. Standard input is never cached."
+        ),
+    )
     args = parser.parse_args()
 
     results = execute_query(
-        args.query, args.delimiter, args.max_columns, args.fixed_string
+        args.query,
+        args.delimiter,
+        args.max_columns,
+        args.fixed_string,
+        default_cache_dir() if args.cache else None,
     )
     print_output(results, args.output_delimiter, args.output_header)
 
@@ -133,16 +156,127 @@ def load_file(
     fixed_string: bool,
 ) -> None:
     def load(file: IO[str]) -> None:
-        rows = read_columns(file, delimiter, max_columns, fixed_string)
+        rows = read_columns(read_lines(file), delimiter, max_columns, fixed_string)
         load_rows(connection, table_name, rows)
 
     if table_name == "-":
-        load(sys.stdin)
+        try:
+            fileno = sys.stdin.fileno()
+        except io.UnsupportedOperation:
+            # Not backed by a file descriptor, e.g. replaced by a StringIO
+            load(sys.stdin)
+            return
+        # Reopen with a larger buffer, keeping the settings of sys.stdin.
+        # CPython only translates newlines on standard input on Windows.
+        newline = None if os.name == "nt" else "\n"
+        with open(
+            fileno,
+            buffering=READ_BUFFER_SIZE,
+            encoding=sys.stdin.encoding,
+            errors=sys.stdin.errors,
+            newline=newline,
+            closefd=False,
+        ) as f:
+            load(f)
     else:
-        with open(table_name) as f:
+        with open(table_name, buffering=READ_BUFFER_SIZE) as f:
             load(f)
 
 
+def default_cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "shellquery")
+
+
+def load_cached_file(
+    connection: sqlite3.Connection,
+    table_name: str,
+    delimiter: str,
+    max_columns: int,
+    fixed_string: bool,
+    cache_dir: str,
+) -> None:
+    """Like load_file, but reuse a database saved in `cache_dir` if the file hasn't changed
+
+    The cached database is attached to `connection`, so SQLite finds the table there.
+    """
+    # Only needed with --cache, so keep them out of the startup time of every other run
+    import glob
+    import hashlib
+    import tempfile
+
+    databases = connection.execute("PRAGMA database_list").fetchall()
+    if sys.version_info >= (3, 11):
+        max_attached = connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    else:
+        max_attached = SQLITE_MAX_ATTACHED
+    # main and temp don't count towards the limit
+    if sum(name not in ("main", "temp") for _, name, _ in databases) >= max_attached:
+        # No room to attach another cache, so load this file the usual way
+        load_file(connection, table_name, delimiter, max_columns, fixed_string)
+        return
+
+    # The table is stored under the name used in the query, so each spelling of a path gets its
+    # own database
+    key = "\0".join(
+        [
+            os.path.abspath(table_name),
+            table_name,
+            delimiter,
+            str(max_columns),
+            str(fixed_string),
+        ]
+    )
+    digest = hashlib.blake2b(key.encode("utf-8", "surrogateescape"), digest_size=16)
+    # The name records the version of the file it was loaded from, so a changed file misses
+    stat = os.stat(table_name)
+    prefix = os.path.join(cache_dir, digest.hexdigest())
+    path = f"{prefix}-{stat.st_mtime_ns}-{stat.st_size}.sqlite3"
+    schema = f"cache{len(databases)}"
+
+    if os.path.exists(path):
+        try:
+            connection.execute("ATTACH DATABASE ? AS ?", (path, schema))
+        except sqlite3.DatabaseError:
+            # Not a database, so rebuild it
+            pass
+        else:
+            found = connection.execute(
+                f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+                (table_name,),
+            ).fetchone()
+            if found:
+                return
+            # Not a database we wrote, so rebuild it
+            connection.execute("DETACH DATABASE ?", (schema,))
+
+    # Build the new database under a temporary name, so other runs never see a partial one
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+    os.close(fd)
+    try:
+        cache = sqlite3.connect(temp_path, isolation_level=None)
+        try:
+            cache.execute("PRAGMA journal_mode = OFF")
+            cache.execute("PRAGMA synchronous = OFF")
+            load_file(cache, table_name, delimiter, max_columns, fixed_string)
+        finally:
+            cache.close()
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    # Remove databases loaded from older versions of the file
+    for old_path in glob.glob(glob.escape(prefix) + "-*.sqlite3"):
+        if old_path != path:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                # Another run removed it first
+                pass
+    connection.execute("ATTACH DATABASE ? AS ?", (path, schema))
+
+
 def re_split(regex: re.Pattern[str], string: str, maxsplit: int) -> list[str]:
     """Same as regex.split(string, maxsplit), but does not include the text in capturing groups.
 
@@ -150,22 +284,120 @@ def re_split(regex: re.Pattern[str], string: str, maxsplit: int) -> list[str]:
     """
     if regex.match(""):
         raise ValueError("Delimiter matching empty string not supported")
+    return split_on_matches(regex, string, maxsplit)
+
+
+def split_on_matches(regex: re.Pattern[str], string: str, maxsplit: int) -> list[str]:
+    """re_split without checking the regex, for callers that checked it once up front"""
     assert maxsplit > 0
-    parts = []
+    parts: list[str] = []
+    append_part = parts.append
     cur = 0
-    for match in regex.finditer(string):
+    # islice stops after maxsplit matches, so the loop doesn't need to count the parts
+    for match in itertools.islice(regex.finditer(string), maxsplit):
         start, end = match.span()
-        assert start < end
-        parts.append(string[cur:start])
+        append_part(string[cur:start])
         cur = end
-        if len(parts) >= maxsplit:
-            break
-    assert cur <= len(string)
     # can be empty if string is empty or there's a match at the end
-    parts.append(string[cur:])
+    append_part(string[cur:])
+    return parts
+
+
+def split_whitespace(string: str, maxsplit: int) -> list[str]:
+    r"""Same as re.split(r"\s+", string, maxsplit), but uses the much faster str.split
+
+    Unlike re.split, str.split drops empty strings at the beginning and end, so those are put back.
+    """
+    assert maxsplit > 0
+    # Split first, since most lines don't start with whitespace
+    parts = string.split(None, maxsplit)
+    if not parts:
+        # string is empty or all whitespace
+        return ["", ""] if string else [""]
+    if string[0].isspace():
+        string = string.lstrip()
+        if maxsplit == 1:
+            return ["", string]
+        return [""] + split_whitespace(string, maxsplit - 1)
+    if len(parts) <= maxsplit and string[-1].isspace():
+        # ran out of whitespace before maxsplit, so the trailing whitespace was a match
+        parts.append("")
     return parts
 
 
+_REGEX_SPECIAL_CHARS = frozenset(r".^$*+?{}[]\|()")
+
+
+@functools.lru_cache(maxsize=None)
+def compile_delimiter(delimiter: str, fixed: bool) -> re.Pattern[str]:
+    """Compile and check a delimiter regex
+
+    Cached because joins load several files with the same delimiter.
+    """
+    col_regex = re.compile(re.escape(delimiter) if fixed else delimiter)
+    if col_regex.match(""):
+        raise ValueError("Delimiter matching empty string not supported")
+    return col_regex
+
+
+def make_splitter(delimiter: str, fixed: bool) -> Callable[[str, int], list[str]]:
+    """Return a function that splits a string into at most maxsplit + 1 columns
+
+    Prefers str.split when it's equivalent, since it's much faster than the regex engine.
+    """
+    if not fixed and delimiter and _REGEX_SPECIAL_CHARS.isdisjoint(delimiter):
+        # e.g. -d , is a regex that only matches itself
+        fixed = True
+    if fixed and delimiter:
+
+        def split_fixed(string: str, maxsplit: int) -> list[str]:
+            return string.split(delimiter, maxsplit)
+
+        return split_fixed
+    if not fixed and delimiter == r"\s+":
+        return split_whitespace
+    col_regex = compile_delimiter(delimiter, fixed)
+    if col_regex.groups:
+        # re.split would include the text of capturing groups
+        return functools.partial(split_on_matches, col_regex)
+    # Without groups, the C implementation behaves the same as re_split
+    return col_regex.split
+
+
+def read_lines(file: IO[str]) -> Iterator[str]:
+    """Yield the lines in the given file without their trailing newlines
+
+    Reads in blocks of READ_BUFFER_SIZE and splits each with a single str.split, which is faster
+    than iterating over the file line by line.
+    """
+
+    def read_blocks() -> Iterator[list[str]]:
+        # Pieces of an incomplete line, joined once its end arrives so long lines aren't copied
+        # over and over
+        pieces: list[str] = []
+        while True:
+            chunk = file.read(READ_BUFFER_SIZE)
+            if not chunk:
+                break
+            if "\n" not in chunk:
+                pieces.append(chunk)
+                continue
+            lines = chunk.split("\n")
+            if pieces:
+                pieces.append(lines[0])
+                lines[0] = "".join(pieces)
+                pieces.clear()
+            # The last piece is an incomplete line, or empty if the chunk ended with a newline
+            pieces.append(lines.pop())
+            yield lines
+        residual = "".join(pieces)
+        if residual:
+            yield [residual]
+
+    # chain iterates over each block in C rather than through another generator frame
+    return itertools.chain.from_iterable(read_blocks())
+
+
 def read_columns(
     file: Iterable[str],
     delimiter: str,
@@ -173,84 +405,149 @@ def read_columns(
     fixed: bool,
 ) -> Iterator[list[str]]:
     """Yield the rows/columns in the given file as a list of lists"""
-    col_regex = re.compile(re.escape(delimiter) if fixed else delimiter)
+    if max_columns <= 1:
+        # Whole lines, so the delimiter doesn't matter
+        for line in file:
+            if line.endswith("\n"):
+                line = line[:-1]
+            yield [line] if line else []
+        return
+    split = make_splitter(delimiter, fixed)
+    maxsplit = max_columns - 1
     for line in file:
         if line.endswith("\n"):
             line = line[:-1]
-        if line:
-            if max_columns > 1:
-                yield re_split(col_regex, line, max_columns - 1)
-            else:
-                yield [line]
-        else:
-            yield []
+        yield split(line, maxsplit) if line else []
 
 
 def load_rows(
     connection: sqlite3.Connection, table: str, data: Iterable[Sequence[object]]
 ) -> None:
-    """Create `table` from the given iterable of rows `data`"""
-    cur_width = 1
-    col_fmt = "c{} TEXT"
-    create_table_stmt = "CREATE TABLE {} ({})".format(
-        quote_identifier(table), col_fmt.format(1)
-    )
-    connection.execute(create_table_stmt)
-
-    current_rows: list[list[object]] = []
+    """Create `table` from the given iterable of rows `data`
 
-    def flush() -> None:
-        placeholders = ",".join("?" * cur_width)
-        insert_query = "INSERT INTO {} VALUES ({})".format(
-            quote_identifier(table), placeholders
-        )
-        connection.executemany(insert_query, current_rows)
-        del current_rows[:]
+    The whole load runs in a single transaction, so SQLite doesn't commit after every batch.
+    Rows that are lists and are shorter than the table get padded with NULLs in place.
+    """
+    col_fmt = "c{} TEXT"
+    quoted_table = quote_identifier(table)
+
+    current_rows: list[Sequence[object]] = []
+    append_row = current_rows.append
+
+    def make_insert_query(num_rows: int) -> str:
+        values = "(" + ",".join("?" * cur_width) + ")"
+        return f"INSERT INTO {quoted_table} VALUES " + ",".join([values] * num_rows)
+
+    # Size the table from the first batch of rows, so jagged input rarely needs an ALTER TABLE
+    rows = iter(data)
+    first_rows = list(itertools.islice(rows, LOAD_ROWS_MAX_BUFFER))
+    cur_width = max(1, max(map(len, first_rows), default=0))
+    padding: list[object] = [None] * cur_width
+    # Only change when the table is widened
+    rows_per_insert = max(1, SQLITE_MAX_VARIABLES // cur_width)
+    insert_query = make_insert_query(rows_per_insert)
+
+    def pad(row: Sequence[object]) -> Sequence[object]:
+        if isinstance(row, list):
+            row.extend(padding[len(row) :])
+            return row
+        else:
+            return [*row, *padding[len(row) :]]
 
-    for row in data:
-        # Expand table if needed
-        while len(row) > cur_width:
-            if current_rows:
-                flush()
+    def widen(width: int) -> None:
+        nonlocal cur_width, rows_per_insert, insert_query
+        for i in range(cur_width, width):
             # sqlite alter table takes constant time, regardless of data already in the table
             # https://www.sqlite.org/lang_altertable.html
             alter_table_statement = "ALTER TABLE {} ADD COLUMN {}".format(
-                quote_identifier(table), col_fmt.format(cur_width + 1)
+                quoted_table, col_fmt.format(i + 1)
             )
             connection.execute(alter_table_statement)
-            cur_width += 1
+        padding.extend([None] * (width - cur_width))
+        cur_width = width
+        rows_per_insert = max(1, SQLITE_MAX_VARIABLES // cur_width)
+        insert_query = make_insert_query(rows_per_insert)
+        # Pad the buffered rows to match, rather than flushing them early
+        current_rows[:] = map(pad, current_rows)
 
-        padded_row = list(row) + [None] * (cur_width - len(row))
-        current_rows.append(padded_row)
-        if len(current_rows) >= LOAD_ROWS_MAX_BUFFER:
-            flush()
-    flush()
+    def flush() -> None:
+        # Insert several rows per statement, which is faster than executemany with one row each
+        for i in range(0, len(current_rows), rows_per_insert):
+            batch = current_rows[i : i + rows_per_insert]
+            if len(batch) == rows_per_insert:
+                query = insert_query
+            else:
+                query = make_insert_query(len(batch))
+            connection.execute(query, list(itertools.chain.from_iterable(batch)))
+        del current_rows[:]
+
+    connection.execute("BEGIN")
+    with connection:
+        create_table_stmt = "CREATE TABLE {} ({})".format(
+            quoted_table, ", ".join(col_fmt.format(i + 1) for i in range(cur_width))
+        )
+        connection.execute(create_table_stmt)
+
+        for row in itertools.chain(first_rows, rows):
+            width = len(row)
+            # Rows that are already full width are buffered as is
+            if width < cur_width:
+                row = pad(row)
+            elif width > cur_width:
+                widen(width)
+            append_row(row)
+            if len(current_rows) >= LOAD_ROWS_MAX_BUFFER:
+                flush()
+        flush()
+
+
+# FROM, and the clauses that come after FROM in a proper SQL statement. Comments, quoted strings
+# and identifiers are matched as a whole first, so keywords inside them are skipped. An
+# unterminated one runs to the end, rather than failing and rescanning from every later quote.
+# Parentheses are matched to track nesting, since e.g. OVER (ORDER BY ...) isn't a clause.
+_KEYWORD_RE = re.compile(
+    r"(?P<comment>--[^\n]*)|/\*.*?(?:\*/|\Z)"
+    r"""|'[^']*(?:'|\Z)|"[^"]*(?:"|\Z)|`[^`]*(?:`|\Z)|\[[^\]]*(?:\]|\Z)"""
+    r"|(?P<open>\()|(?P<close>\))"
+    r"|\b(?P<from>FROM)\b|\b(?P<clause>WHERE|GROUP\s+BY|ORDER\s+BY|LIMIT)\b",
+    re.I | re.S,
+)
+_SELECT_RE = re.compile(r"\s*(?:SELECT|WITH)\b", re.I)
 
 
 def add_from_clause(query: str, table: str) -> str:
     """If the query doesn't have a FROM clause, add it using the given table."""
-    # Note: doesn't work when query has FROM, GROUP BY, or ORDER BY as a non-keyword
-    if re.search(r"\bFROM\b", query, re.I):
-        # already has a from clause
-        return query
-    else:
-        clause = f"FROM {quote_identifier(table)} "
-        # These are in order of how they should appear in a proper SQL statement
-        key_words = [r"WHERE", r"GROUP\s+BY", r"ORDER\s+BY", "LIMIT"]
-        for word in key_words:
-            match = re.search(r"\b" + word + r"\b", query, re.I)
-            if match:
-                # Insert FROM clause before the group/order clause
-                start = match.start()
-                return query[:start] + clause + query[start:]
-        # didn't find GROUP BY or ORDER BY clause, so append to end
-        return query + " " + clause
+    clause_start = None
+    comment_end = None
+    depth = 0
+    for match in _KEYWORD_RE.finditer(query):
+        kind = match.lastgroup
+        if kind == "from":
+            # already has a from clause
+            return query
+        elif kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+        elif kind == "comment":
+            comment_end = match.end()
+        elif kind == "clause" and depth == 0 and clause_start is None:
+            clause_start = match.start()
+    clause = f"FROM {quote_identifier(table)} "
+    if clause_start is not None:
+        # Insert FROM clause before the first of those clauses outside of parentheses
+        return query[:clause_start] + clause + query[clause_start:]
+    # didn't find any of them, so append to end
+    if comment_end == len(query):
+        # Start a new line, or the clause would be part of the trailing comment
+        return query + "\n" + clause
+    return query + " " + clause
 
 
 def add_select(query: str) -> str:
     """If the query doesn't start with SELECT or WITH, add it."""
     # Note: doesn't work if there are comments in the beginning of the query
-    if re.match(r"\s*(SELECT|WITH)\b", query, re.I):
+    if _SELECT_RE.match(query):
         return query
     else:
         return "SELECT " + query
@@ -267,54 +564,84 @@ def quote_identifier(name: str) -> str:
 
 
 def execute_query(
-    query: str, delimiter: str, max_columns: int, fixed_string: bool
+    query: str,
+    delimiter: str,
+    max_columns: int,
+    fixed_string: bool,
+    cache_dir: str | None = None,
 ) -> sqlite3.Cursor:
     processed_query = add_from_clause(add_select(query), "-")
-    with tempfile.NamedTemporaryFile() as temp_file:
-        connection = sqlite3.connect(temp_file.name)
-        # Let SQLite tell me what tables I need to load by repeatedly running the query.
-        # This is really hacky but it's more robust than trying to regex parse the query.
-        # e.g. this correctly handles aliasing
-        results: sqlite3.Cursor | None = None
-        loaded: set[str] = set()
-        while results is None:
-            cursor = connection.cursor()
-            try:
-                cursor.execute(processed_query)
-            except sqlite3.OperationalError as e:
-                no_such_table = "no such table: "
-                msg: str = e.args[0]
-                if msg.startswith(no_such_table):
-                    table_name = msg[len(no_such_table) :]
-                    # SQLite treats "SELECT * FROM foo.log" as database foo, table log
-                    # We could try to magically handle this, but SELECT * FROM "foo.log" gives the
-                    # same message.
-                    error = "Should have already loaded {}. You might need to quote the table name"
-                    assert table_name not in loaded, error.format(table_name)
+    # An empty file name gives a private temporary database. It stays in SQLite's page cache unless
+    # it gets too big, and then spills over to a temporary file.
+    # load_rows manages its own transactions, so turn off the sqlite3 module's implicit ones.
+    connection = sqlite3.connect("", isolation_level=None)
+    # The database is thrown away after the query, so it doesn't need to survive crashes
+    connection.execute("PRAGMA journal_mode = MEMORY")
+    connection.execute("PRAGMA synchronous = OFF")
+    loaded: set[str] = set()
+    # Let SQLite tell me what tables I need to load by repeatedly running the query.
+    # This is really hacky but it's more robust than trying to regex parse the query.
+    # e.g. this correctly handles aliasing
+    results: sqlite3.Cursor | None = None
+    cursor = connection.cursor()
+    while results is None:
+        try:
+            cursor.execute(processed_query)
+        except sqlite3.OperationalError as e:
+            no_such_table = "no such table: "
+            msg: str = e.args[0]
+            if msg.startswith(no_such_table):
+                table_name = msg[len(no_such_table) :]
+                # SQLite treats "SELECT * FROM foo.log" as database foo, table log
+                # We could try to magically handle this, but SELECT * FROM "foo.log" gives the
+                # same message.
+                error = "Should have already loaded {}. You might need to quote the table name"
+                assert table_name not in loaded, error.format(table_name)
+                if cache_dir is None or table_name == "-":
                     load_file(
                         connection, table_name, delimiter, max_columns, fixed_string
                     )
-                    loaded.add(table_name)
                 else:
-                    _logger.error("Failed to execute: %s", processed_query)
-                    raise
+                    load_cached_file(
+                        connection,
+                        table_name,
+                        delimiter,
+                        max_columns,
+                        fixed_string,
+                        cache_dir,
+                    )
+                loaded.add(table_name)
             else:
-                results = cursor
-        return results
+                _logger.error("Failed to execute: %s", processed_query)
+                raise
+        else:
+            results = cursor
+    return results
 
 
-def print_output(rows: sqlite3.Cursor, delimiter: str, header: bool) -> None:
-    def stringify(col: object) -> str:
-        if col is None:
-            return "NULL"
-        else:
-            return str(col)
+def stringify(col: object) -> str:
+    return "NULL" if col is None else str(col)
+
 
+def print_output(rows: sqlite3.Cursor, delimiter: str, header: bool) -> None:
+    write = sys.stdout.write
     try:
         if header:
-            print(delimiter.join(map(stringify, (col[0] for col in rows.description))))
-        for row in rows:
-            print(delimiter.join(map(stringify, row)))
+            columns = (col[0] for col in rows.description)
+            write(delimiter.join(map(stringify, columns)) + "\n")
+        # Fetch and write in batches to cut down on calls into sqlite3 and write calls
+        rows.arraysize = max(1, PRINT_OUTPUT_MAX_BUFFER)
+        while True:
+            batch = rows.fetchmany()
+            if not batch:
+                break
+            try:
+                # Columns are usually all TEXT, so try joining without converting each cell
+                text = "\n".join([delimiter.join(row) for row in batch])
+            except TypeError:
+                text = "\n".join([delimiter.join(map(stringify, row)) for row in batch])
+            write(text)
+            write("\n")
     except OSError as e:
         if e.errno == errno.EPIPE:
             # ignore, happens when piping the output to things like `head`
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import io
 import os.path
+import pathlib
 import random
 import re
 import sqlite3
@@ -41,6 +42,38 @@ def test_read_columns_capturing_group() -> None:
     ]
 
 
+def test_read_columns_fixed_literal() -> None:
+    """Fixed delimiters split on the exact string with no CSV-style special cases"""
+    lines = ['a,"b,c"', "a\rb,c", "x" * 200 * 1000 + ",y"]
+    assert list(shellquery.read_columns(lines, ",", 99, True)) == [
+        ["a", '"b', 'c"'],
+        ["a\rb", "c"],
+        ["x" * 200 * 1000, "y"],
+    ]
+
+
+def test_read_columns_empty_delimiter() -> None:
+    with pytest.raises(ValueError, match="empty string"):
+        list(shellquery.read_columns(["a b"], "x*", 99, False))
+    with pytest.raises(ValueError, match="empty string"):
+        list(shellquery.read_columns(["a b"], "", 99, True))
+    with pytest.raises(ValueError, match="empty string"):
+        list(shellquery.read_columns(["a b"], "(x)*", 99, False))
+
+
+def test_read_lines() -> None:
+    for text in ["", "\n", "a", "a\n", "a\n\nbc\n", "abc\ndef", "\n\nabcdef\n\n"]:
+        expected = text.splitlines()
+        for size in [1, 2, 3, 1024]:
+            with mock.patch.object(shellquery, "READ_BUFFER_SIZE", size):
+                assert list(shellquery.read_lines(io.StringIO(text))) == expected
+    # A line many blocks long
+    text = "a\n" + "b" * 1000 + "\nc" + "d" * 1000
+    with mock.patch.object(shellquery, "READ_BUFFER_SIZE", 7):
+        lines = list(shellquery.read_lines(io.StringIO(text)))
+    assert lines == ["a", "b" * 1000, "c" + "d" * 1000]
+
+
 def test_read_columns_empty() -> None:
     assert list(shellquery.read_columns([], " ", 99, True)) == []
 
@@ -48,6 +81,11 @@ def test_read_columns_empty() -> None:
 def test_read_columns_max_columns() -> None:
     assert list(shellquery.read_columns(["a b c d"], " ", 2, True)) == [["a", "b c d"]]
     assert list(shellquery.read_columns(["a b c d"], " ", 1, True)) == [["a b c d"]]
+    # The delimiter isn't used, so it doesn't need to be valid
+    assert list(shellquery.read_columns(["a(b\n", "\n"], "(", 1, False)) == [
+        ["a(b"],
+        [],
+    ]
 
 
 def test_load_rows() -> None:
@@ -65,6 +103,7 @@ def test_load_rows() -> None:
         ]
 
         shellquery.load_rows(connection, "x", data)
+        assert not connection.in_transaction
         cursor = connection.cursor()
         cursor.execute("SELECT * FROM x ORDER BY c1, c2, c3, c4, c5")
         assert cursor.fetchall() == [
@@ -83,6 +122,36 @@ def test_load_rows() -> None:
         do_test()
     with mock.patch.object(shellquery, "LOAD_ROWS_MAX_BUFFER", 0):
         do_test()
+    # Widens the table while rows are buffered
+    with mock.patch.object(shellquery, "LOAD_ROWS_MAX_BUFFER", 3):
+        do_test()
+    # Splits each flush across several INSERT statements, including a partial one
+    for size in [3, 1000]:
+        with mock.patch.object(shellquery, "LOAD_ROWS_MAX_BUFFER", size):
+            with mock.patch.object(shellquery, "SQLITE_MAX_VARIABLES", 11):
+                do_test()
+
+
+def test_load_rows_no_alter() -> None:
+    """The table is created wide enough for the first batch of rows"""
+    connection = sqlite3.connect(":memory:")
+    statements: list[str] = []
+    connection.set_trace_callback(statements.append)
+    shellquery.load_rows(connection, "x", [["a"], ["a", "b", "c"], [], ["a", "b"]])
+    assert not [s for s in statements if s.startswith("ALTER")]
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM x")
+    assert len(cursor.description) == 3
+
+
+def test_load_rows_tuples() -> None:
+    connection = sqlite3.connect(":memory:")
+    data = [("a",), ("b", "c")]
+    shellquery.load_rows(connection, "x", data)
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM x ORDER BY c1")
+    assert cursor.fetchall() == [("a", None), ("b", "c")]
+    assert data == [("a",), ("b", "c")]
 
 
 def test_load_rows_ugly_name() -> None:
@@ -133,6 +202,58 @@ def test_add_from_clause() -> None:
     assert (
         shellquery.add_from_clause("c1 limit 1", "table") == 'c1 FROM "table" limit 1'
     )
+    assert (
+        shellquery.add_from_clause("c1 order by (select 1 where true)", "table")
+        == 'c1 FROM "table" order by (select 1 where true)'
+    )
+    # Clauses inside parentheses are skipped
+    assert (
+        shellquery.add_from_clause("row_number() OVER (ORDER BY c1) WHERE c1 > 1", "-")
+        == 'row_number() OVER (ORDER BY c1) FROM "-" WHERE c1 > 1'
+    )
+    assert (
+        shellquery.add_from_clause("group_concat(c1 ORDER BY c1) LIMIT 1", "-")
+        == 'group_concat(c1 ORDER BY c1) FROM "-" LIMIT 1'
+    )
+    assert (
+        shellquery.add_from_clause("max(c1 ORDER BY c1)", "-")
+        == 'max(c1 ORDER BY c1) FROM "-" '
+    )
+    # Keywords in quoted strings and identifiers are skipped
+    assert (
+        shellquery.add_from_clause("c1 = 'from x' where \"limit\"", "table")
+        == 'c1 = \'from x\' FROM "table" where "limit"'
+    )
+    assert (
+        shellquery.add_from_clause("'it''s from' `where` [from] limit 1", "table")
+        == "'it''s from' `where` [from] FROM \"table\" limit 1"
+    )
+    # Keywords and quotes in comments are skipped
+    assert (
+        shellquery.add_from_clause("c1 -- don't from\nWHERE c1 > 1", "-")
+        == 'c1 -- don\'t from\nFROM "-" WHERE c1 > 1'
+    )
+    assert (
+        shellquery.add_from_clause("c1 /* it's\nfrom */ LIMIT 1 /* where", "-")
+        == 'c1 /* it\'s\nfrom */ FROM "-" LIMIT 1 /* where'
+    )
+    # The clause can't go after a trailing line comment on the same line
+    assert (
+        shellquery.add_from_clause("c1 -- only c1", "-") == 'c1 -- only c1\nFROM "-" '
+    )
+    assert (
+        shellquery.add_from_clause("c1 -- only c1\n", "-")
+        == 'c1 -- only c1\n FROM "-" '
+    )
+    # An unterminated quote hides the rest of the query
+    assert shellquery.add_from_clause("c1 [where", "table") == 'c1 [where FROM "table" '
+
+
+def test_add_from_clause_unterminated_quotes() -> None:
+    """Scanning many unterminated quotes takes linear time, not quadratic"""
+    for quote in ["'", '"', "`", "[", "/*"]:
+        query = "c1 " + (quote + "x ") * 100000
+        assert shellquery.add_from_clause(query, "t") == query + ' FROM "t" '
 
 
 def test_add_select() -> None:
@@ -183,6 +304,14 @@ def test_stdin() -> None:
     assert output == "boring\tvalue\n"
 
 
+def test_stdin_file() -> None:
+    """Test reading from stdin backed by a file descriptor"""
+    path = os.path.join(os.path.dirname(__file__), "test_data", "中 文")
+    with open(path, encoding="utf-8") as data, mock.patch("sys.stdin", data):
+        results = shellquery.execute_query("c1", r"\s+", 100, False)
+        assert results.fetchall() == [("中文",), ("a",)]
+
+
 def test_unicode_stdin() -> None:
     """Test unicode on stdin, full stack"""
     with open(os.path.join(os.path.dirname(__file__), "test_data", "中 文")) as data:
@@ -195,6 +324,132 @@ def test_unicode_stdin() -> None:
     assert output.decode() == "中文\na\n"
 
 
+def test_cache(tmp_path: pathlib.Path) -> None:
+    """Test reusing loaded files with --cache"""
+    cache_dir = str(tmp_path / "cache")
+    data_path = tmp_path / "data"
+    data_path.write_text("a 1\nb 2\n")
+    query = f"SELECT c1, c2 FROM {shellquery.quote_identifier(str(data_path))}"
+
+    def run() -> list[tuple[str, ...]]:
+        results = shellquery.execute_query(query, r"\s+", 100, False, cache_dir)
+        return results.fetchall()
+
+    with mock.patch.object(shellquery, "load_file", wraps=shellquery.load_file) as load:
+        assert run() == [("a", "1"), ("b", "2")]
+        assert load.call_count == 1
+        assert run() == [("a", "1"), ("b", "2")]
+        assert load.call_count == 1
+
+        # Changing the file invalidates the cache
+        data_path.write_text("c 3\n")
+        assert run() == [("c", "3")]
+        assert load.call_count == 2
+        assert run() == [("c", "3")]
+        assert load.call_count == 2
+        # The database for the old version of the file is gone
+        assert len(list((tmp_path / "cache").iterdir())) == 1
+
+        # Different options need a different cache
+        whole_lines = query.replace("c1, c2", "*")
+        results = shellquery.execute_query(whole_lines, r"\s+", 1, False, cache_dir)
+        assert results.fetchall() == [("c 3",)]
+        assert load.call_count == 3
+
+    # Garbage in the cache gets replaced
+    for path in (tmp_path / "cache").iterdir():
+        path.write_text("garbage")
+    assert run() == [("c", "3")]
+
+    # So does a database without the table
+    for path in (tmp_path / "cache").iterdir():
+        path.unlink()
+        sqlite3.connect(str(path)).execute("CREATE TABLE other (c1)").connection.close()
+    assert run() == [("c", "3")]
+
+
+def test_cache_table_names(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Cached databases only contain the loaded table, so other names still refer to files"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "a").write_text("a\n")
+    (tmp_path / "shellquery_source").write_text("b\n")
+    query = "SELECT * FROM a JOIN shellquery_source"
+    for _ in range(2):
+        results = shellquery.execute_query(query, r"\s+", 100, False, "cache")
+        assert results.fetchall() == [("a", "b")]
+
+
+def test_cache_same_file_different_names(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Each spelling of a path names its own table"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").write_text("a\n")
+    absolute = shellquery.quote_identifier(str(tmp_path / "data"))
+    for query, expected in [
+        ("SELECT * FROM data", [("a",)]),
+        (f"SELECT * FROM {absolute}", [("a",)]),
+        ('SELECT * FROM data JOIN "./data"', [("a", "a")]),
+    ]:
+        for _ in range(2):
+            results = shellquery.execute_query(query, r"\s+", 100, False, "cache")
+            assert results.fetchall() == expected
+
+
+def test_cache_many_files(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Files beyond SQLite's limit on attached databases are loaded without the cache"""
+    monkeypatch.chdir(tmp_path)
+    names = [f"f{i}" for i in range(shellquery.SQLITE_MAX_ATTACHED + 2)]
+    for name in names:
+        (tmp_path / name).write_text(name + "\n")
+    query = "SELECT * FROM " + " JOIN ".join(names)
+    for _ in range(2):
+        results = shellquery.execute_query(query, r"\s+", 100, False, "cache")
+        assert results.fetchall() == [tuple(names)]
+
+
+def test_default_cache_dir(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", "/xdg")
+    assert shellquery.default_cache_dir() == os.path.join("/xdg", "shellquery")
+    monkeypatch.setenv("XDG_CACHE_HOME", "")
+    monkeypatch.setenv("HOME", "/home/me")
+    expected = os.path.join(os.path.expanduser("~/.cache"), "shellquery")
+    assert shellquery.default_cache_dir() == expected
+
+
+def test_cache_error(tmp_path: pathlib.Path) -> None:
+    """Failing to load a file doesn't leave anything in the cache"""
+    data_path = tmp_path / "data"
+    data_path.write_text("a 1\n")
+    query = f"SELECT * FROM {shellquery.quote_identifier(str(data_path))}"
+    with pytest.raises(ValueError, match="empty string"):
+        shellquery.execute_query(query, "", 100, True, str(tmp_path / "cache"))
+    assert not list((tmp_path / "cache").iterdir())
+
+
+def test_syntax_error_before_stdin() -> None:
+    """A malformed query fails without waiting for standard input"""
+    stdin = mock.Mock(wraps=io.StringIO("a"))
+    with mock.patch("sys.stdin", stdin):
+        with pytest.raises(sqlite3.OperationalError, match="syntax error"):
+            shellquery.execute_query("c1 ((", r"\s+", 100, False)
+    assert not stdin.read.called
+
+
+def test_cache_stdin(tmp_path: pathlib.Path) -> None:
+    """Standard input isn't cached"""
+    with mock.patch("sys.stdin", io.StringIO("a b")):
+        results = shellquery.execute_query(
+            'SELECT * FROM "-"', r"\s+", 100, False, str(tmp_path)
+        )
+        assert results.fetchall() == [("a", "b")]
+    assert not list(tmp_path.iterdir())
+
+
 def test_header() -> None:
     """Test the --output-header option"""
     output = _run_main_test(["'中' AS 文", "--output-header"], "a")
@@ -205,6 +460,20 @@ def test_header() -> None:
     assert output.splitlines() == ["colname"]
 
 
+def test_print_output_buffer() -> None:
+    """Test output with buffers smaller than the number of rows"""
+    for size in [0, 1, 2]:
+        with mock.patch.object(shellquery, "PRINT_OUTPUT_MAX_BUFFER", size):
+            output = _run_main_test(["*", "-H"], "a b\nc\nd e f\n")
+        assert output == "c1\tc2\tc3\na\tb\tNULL\nc\tNULL\tNULL\nd\te\tf\n"
+        # Mix of all-TEXT rows and rows with other types
+        with mock.patch.object(shellquery, "PRINT_OUTPUT_MAX_BUFFER", size):
+            output = _run_main_test(
+                ["c1, CASE c1 WHEN 'a' THEN length(c1) ELSE c1 END"], "a\nbb\n"
+            )
+        assert output == "a\t1\nbb\tbb\n"
+
+
 def test_examples() -> None:
     """Verify the examples in the argparse help text"""
     progname = sys.executable + " " + shellquery.__file__
@@ -295,3 +564,46 @@ def test_re_split() -> None:
 def test_re_split_empty() -> None:
     with pytest.raises(ValueError, match="empty string"):
         shellquery.re_split(re.compile(""), "data", 1)
+
+
+def test_split_whitespace_randomly() -> None:
+    """Test split_whitespace against re.split by generating random test cases"""
+    regex = re.compile(r"\s+")
+    for _ in range(10 * 1000):
+        length = random.randint(0, 10)
+        string = "".join(random.choice("ab \t　") for _ in range(length))
+        maxsplit = random.randint(1, 10)
+        assert regex.split(string, maxsplit) == shellquery.split_whitespace(
+            string, maxsplit
+        ), f"{string=}, {maxsplit=}"
+
+
+def test_compile_delimiter() -> None:
+    regex = shellquery.compile_delimiter("a+", False)
+    assert shellquery.compile_delimiter("a+", False) is regex
+    assert shellquery.compile_delimiter("a+", True).pattern == r"a\+"
+    with pytest.raises(ValueError, match="empty string"):
+        shellquery.compile_delimiter("a*", False)
+
+
+def test_make_splitter() -> None:
+    """The str.split fast paths should match splitting with the regex"""
+    for delimiter, fixed in [
+        (r"\s+", False),
+        (".", True),
+        ("ab", True),
+        (".", False),
+        ("ab", False),
+        (" ", False),
+        (r"\.", False),
+    ]:
+        split = shellquery.make_splitter(delimiter, fixed)
+        regex = re.compile(re.escape(delimiter) if fixed else delimiter)
+        for string in ["", "a", " a. b ", "..ab.a b.ba", "  a  b  "]:
+            for maxsplit in range(1, 5):
+                assert split(string, maxsplit) == regex.split(string, maxsplit)
+                # Same through read_columns, which also turns empty lines into empty rows
+                columns = list(
+                    shellquery.read_columns([string], delimiter, maxsplit + 1, fixed)
+                )
+                assert columns == ([regex.split(string, maxsplit)] if string else [[]])